@@ -1,50 +1,565 @@
 import z5py
 import numpy as np
 
-# Uses zyx order
-def valid_data_generator_n5(container_path, dataset_path, sample_shape, batch_size):
+import csv
+import hashlib
+import itertools
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+## All generators:
+
+## dtype is the dtype of the yielded batches. Float dtypes are normalised to [0, 1] in place,
+## uint8 batches are yielded as stored, leaving the normalisation to the consumer (e.g. on the GPU)
+## Batches are written into a ring of ring_size preallocated buffers, so a yielded batch is only valid
+## until ring_size-1 more batches have been drawn. When prefetching, this has to be more than the
+## number of batches that can be queued up (see prefetch_generator)
+## cache is None (read every sample from z5py), "memory" or "memmap", in which case the part of the volume
+## samples are drawn from is loaded once (see load_region), into RAM or a uint8 memmap under cache_dir
+## chunk_cache_bytes, if nonzero, puts an LRU cache of decompressed chunks of that size in front of the dataset (see ChunkCache)
+## occupancy_threshold, if given, is a (min_mean, min_std) pair, and only crops centred in chunks whose mean and
+## standard deviation reach both are drawn, to skip padding and resin (see get_occupancy_index)
+## seed is an int, SeedSequence or random generator (see get_rng) all sampling is drawn from (None for a fresh random seed).
+## Generators running in parallel should each get their own stream (see spawn_seeds), or they will draw the same crops
+
+class LegacySeedSequence(object):
+	""" Stand-in for np.random.SeedSequence on numpy < 1.17, spawning children by extending spawn_key. """
+	def __init__(self, entropy=None, spawn_key=()):
+		self.entropy = entropy if entropy is not None else int.from_bytes(os.urandom(16), "little")
+		self.spawn_key = tuple(spawn_key)
+		self.n_children_spawned = 0
+
+	def spawn(self, count):
+		children = [LegacySeedSequence(self.entropy, self.spawn_key + (self.n_children_spawned + i,)) for i in range(count)]
+		self.n_children_spawned += count
+		return children
+
+	def state(self):
+		""" The entropy and spawn key as 32 bit words, to seed a np.random.RandomState with. """
+		words = [(self.entropy >> shift) & 0xffffffff for shift in range(0, max(self.entropy.bit_length(), 1), 32)]
+		return words + [len(self.spawn_key)] + [k & 0xffffffff for k in self.spawn_key]
+
+class LegacyGenerator(np.random.RandomState):
+	""" np.random.RandomState with the parts of the np.random.Generator interface used here, for numpy < 1.17. """
+	def integers(self, low, high=None, size=None):
+		if high is None:
+			low, high = 0, low
+		if np.ndim(low) == 0 and np.ndim(high) == 0:
+			return self.randint(low, high, size)
+		# randint only takes array bounds from numpy 1.15 on
+		low, high = np.asarray(low), np.asarray(high)
+		shape = size if size is not None else np.broadcast(low, high).shape
+		return low + np.floor(self.random_sample(shape)*(high - low)).astype(np.int64)
+
+## np.random.Generator and SeedSequence need numpy >= 1.17, older versions fall back to the classes above
+SeedSequence = getattr(np.random, "SeedSequence", LegacySeedSequence)
+GENERATOR_TYPES = tuple(t for t in (getattr(np.random, "Generator", None), LegacyGenerator) if t is not None)
+
+def get_rng(seed=None):
+	if isinstance(seed, GENERATOR_TYPES):
+		return seed
+	if hasattr(np.random, "default_rng"):
+		return np.random.default_rng(seed)
+	if not isinstance(seed, LegacySeedSequence):
+		seed = LegacySeedSequence(seed)
+	return LegacyGenerator(seed.state())
+
+def spawn_seeds(seed, count):
+	""" Splits seed (int, SeedSequence or None) into count independent seeds, e.g. one per worker. """
+	if not isinstance(seed, SeedSequence):
+		seed = SeedSequence(seed)
+	return seed.spawn(count)
+
+def get_batch_ring(batch_size, sample_shape, dtype, ring_size):
+	return itertools.cycle([np.empty((batch_size, *sample_shape, 1), dtype=dtype) for _ in range(ring_size)])
+
+def normalize_batch(batch):
+	if np.issubdtype(batch.dtype, np.floating):
+		np.multiply(batch, batch.dtype.type(1/255.), out=batch)
+	return batch
+
+
+class ChunkCache(object):
+	""" LRU cache of decompressed chunks in front of a z5py dataset, holding up to max_bytes of chunk data.
+	Slicing it works like slicing the dataset (contiguous slices only), with the result assembled from
+	cached chunks where possible. hits and misses count chunk lookups.
+	"""
+	def __init__(self, data, max_bytes):
+		self.data = data
+		self.shape = data.shape
+		self.chunks = data.chunks
+		self.dtype = data.dtype
+		self.max_bytes = max_bytes
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.cached = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get_chunk(self, index):
+		with self.lock:
+			if index in self.cached:
+				self.hits += 1
+				self.cached.move_to_end(index)
+				return self.cached[index]
+			self.misses += 1
+
+		chunk = self.data[tuple(slice(i*c, min((i+1)*c, size)) for i, c, size in zip(index, self.chunks, self.shape))]
+
+		with self.lock:
+			if index not in self.cached:
+				self.cached[index] = chunk
+				self.nbytes += chunk.nbytes
+			while self.nbytes > self.max_bytes and len(self.cached) > 1:
+				self.nbytes -= self.cached.popitem(last=False)[1].nbytes
+		return chunk
+
+	def __getitem__(self, key):
+		bounds = [(0 if k.start is None else k.start, size if k.stop is None else min(k.stop, size)) for k, size in zip(key, self.shape)]
+		out = np.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+
+		for index in itertools.product(*(range(start//c, (stop-1)//c + 1) for (start, stop), c in zip(bounds, self.chunks))):
+			chunk = self.get_chunk(index)
+			chunk_starts = [i*c for i, c in zip(index, self.chunks)]
+			overlap = [(max(start, chunk_start), min(stop, chunk_start + c)) for (start, stop), chunk_start, c in zip(bounds, chunk_starts, self.chunks)]
+			out[tuple(slice(lo - start, hi - start) for (lo, hi), (start, _) in zip(overlap, bounds))] = \
+				chunk[tuple(slice(lo - chunk_start, hi - chunk_start) for (lo, hi), chunk_start in zip(overlap, chunk_starts))]
+		return out
+
+	def stats(self):
+		with self.lock:
+			lookups = self.hits + self.misses
+			return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits/lookups if lookups else 0., "nbytes": self.nbytes}
+
+
+## Chunk caches are shared between all the generators in the process reading the same dataset
+_chunk_caches = {}
+_chunk_caches_lock = threading.Lock()
+
+def get_chunk_cache(data, container_path, dataset_path, max_bytes):
+	with _chunk_caches_lock:
+		key = (os.path.abspath(container_path), dataset_path, max_bytes)
+		if key not in _chunk_caches:
+			_chunk_caches[key] = ChunkCache(data, max_bytes)
+		return _chunk_caches[key]
+
+def chunk_cache_stats():
+	with _chunk_caches_lock:
+		return {"%s:%s" % key[:2]: cache.stats() for key, cache in _chunk_caches.items()}
+
+def open_dataset(container_path, dataset_path, chunk_cache_bytes=0):
 	data = z5py.File(container_path, use_zarr_format=False)[dataset_path]
+	if chunk_cache_bytes > 0:
+		data = get_chunk_cache(data, container_path, dataset_path, chunk_cache_bytes)
+	return data
+
+
+## Loads region (a (start, stop) pair per axis, None for the whole axis) of data, so random crops can be served
+## from it without decompressing the same chunks again for every batch. If memmap_path is given, the region is
+## kept in a memmap there instead of in memory, and an existing memmap from an earlier run is reused.
+def load_region(data, region, memmap_path=None):
+	region = [(0, size) if bounds is None else bounds for bounds, size in zip(region, data.shape)]
+	shape = tuple(stop - start for start, stop in region)
+
+	if memmap_path is None:
+		return data[tuple(slice(start, stop) for start, stop in region)]
+
+	if os.path.exists(memmap_path):
+		return np.load(memmap_path, mmap_mode="r")
+
+	os.makedirs(os.path.dirname(memmap_path), exist_ok=True)
+	cache = np.lib.format.open_memmap(memmap_path + ".tmp", mode="w+", dtype=data.dtype, shape=shape)
+	# fill it a slab at a time, so the region never has to fit into memory
+	step = data.chunks[0] if hasattr(data, "chunks") else 64
+	for z in range(0, shape[0], step):
+		cache[z:z+step] = data[region[0][0]+z:min(region[0][0]+z+step, region[0][1]),
+								region[1][0]:region[1][1],
+								region[2][0]:region[2][1]]
+	cache.flush()
+	del cache
+	os.replace(memmap_path + ".tmp", memmap_path)
+	return np.load(memmap_path, mmap_mode="r")
+
+## Loaded regions are shared between all the generators in the process (e.g. prefetch workers), rather than loaded once each
+_loaded_regions = {}
+_loaded_regions_lock = threading.Lock()
+
+def get_cached_data(data, container_path, dataset_path, region, cache, cache_dir):
+	if cache is None:
+		return data
+	if cache not in ("memory", "memmap"):
+		raise ValueError("Unknown cache type %s" % cache)
+
+	key = hashlib.md5(repr((os.path.abspath(container_path), dataset_path, tuple(region))).encode()).hexdigest()
+	with _loaded_regions_lock:
+		if (key, cache) not in _loaded_regions:
+			memmap_path = os.path.join(cache_dir, key + ".npy") if cache == "memmap" else None
+			_loaded_regions[(key, cache)] = load_region(data, region, memmap_path)
+		return _loaded_regions[(key, cache)]
+
+
+## Computes the mean and standard deviation of every chunk of data, as a float32 array of shape (2, *chunk_grid_shape).
+## Works through one row of chunks at a time, so it takes a single pass over the volume.
+def compute_occupancy_index(data):
+	chunks = data.chunks
+	grid = [-(-size//c) for size, c in zip(data.shape, chunks)]
+	index = np.zeros((2, *grid), dtype=np.float32)
+
+	for z, y in itertools.product(range(grid[0]), range(grid[1])):
+		row = data[z*chunks[0]:(z+1)*chunks[0], y*chunks[1]:(y+1)*chunks[1], :].astype(np.float32)
+		for x in range(grid[2]):
+			chunk = row[:, :, x*chunks[2]:(x+1)*chunks[2]]
+			index[0, z, y, x] = chunk.mean()
+			index[1, z, y, x] = chunk.std()
+	return index
+
+_occupancy_indices = {}
+_occupancy_indices_lock = threading.Lock()
+
+## Returns the occupancy index of a dataset, which is kept as a sidecar dataset (dataset_path + "_occupancy") in the
+## same container. It's computed (see compute_occupancy_index) and written there the first time it's asked for.
+def get_occupancy_index(container_path, dataset_path):
+	with _occupancy_indices_lock:
+		key = (os.path.abspath(container_path), dataset_path)
+		if key not in _occupancy_indices:
+			container = z5py.File(container_path, use_zarr_format=False)
+			index_path = dataset_path.rstrip("/") + "_occupancy"
+			if index_path in container:
+				index = container[index_path][:]
+			else:
+				index = compute_occupancy_index(container[dataset_path])
+				container.create_dataset(index_path, shape=index.shape, chunks=index.shape, dtype="float32")[:] = index
+			_occupancy_indices[key] = index
+		return _occupancy_indices[key]
+
+
+class OccupancySampler(object):
+	""" Draws crop starts whose centres lie in informative chunks, i.e. those whose mean and standard deviation
+	in the occupancy index reach min_mean and min_std. A chunk is picked uniformly from a precomputed list of
+	informative chunks and the centre uniformly within it, so a draw is O(1) however sparse the data is.
+
+	mask     -> optional boolean array over the chunk grid, further limiting which chunks can be picked
+	offset   -> start of the (cached) region crops are taken from, in dataset coordinates
+	shape    -> shape of that region
+	"""
+	def __init__(self, index, chunks, min_mean, min_std, offset, shape, mask=None):
+		informative = (index[0] >= min_mean) & (index[1] >= min_std)
+		if mask is not None:
+			informative &= mask
+		self.informative = np.argwhere(informative)
+		if len(self.informative) == 0:
+			raise ValueError("No chunks meet the occupancy threshold!")
+		self.chunks = np.array(chunks)
+		self.offset = np.array(offset)
+		self.shape = np.array(shape)
+
+	def sample_starts(self, rng, count, sample_shape):
+		""" Returns a (count, 3) array of crop starts within the region. """
+		chunk = self.informative[rng.integers(0, len(self.informative), count)]
+		centres = chunk*self.chunks + rng.integers(0, self.chunks, (count, 3))
+		starts = centres - self.offset - np.array(sample_shape)//2
+		return np.clip(starts, 0, self.shape - np.array(sample_shape))
+
+def get_occupancy_sampler(container_path, dataset_path, data, occupancy_threshold, region, mask=None):
+	""" Builds an OccupancySampler for crops from region ((start, stop) or None per axis) of the dataset. """
+	index = get_occupancy_index(container_path, dataset_path)
+	chunks = z5py.File(container_path, use_zarr_format=False)[dataset_path].chunks
+	offset = [0 if bounds is None else bounds[0] for bounds in region]
+
+	# leave out chunks entirely outside the region
+	region_mask = np.zeros(index.shape[1:], dtype=bool)
+	region_mask[tuple(slice(start//c, -(-(start + size)//c)) for start, size, c in zip(offset, data.shape, chunks))] = True
+	if mask is not None:
+		region_mask &= mask
+
+	return OccupancySampler(index, chunks, occupancy_threshold[0], occupancy_threshold[1], offset, data.shape, region_mask)
+
+
+## Draws crops_per_block crops of sample_shape from each of a series of random chunk-aligned blocks, so every
+## chunk read gets used several times. Crops start anywhere within the first chunk of their block, and blocks are
+## picked in proportion to how many start positions they hold, so over many blocks every start position is equally likely.
+## With an occupancy sampler, blocks are instead the ones holding crop starts drawn by the sampler.
+def block_crop_generator(data, sample_shape, crops_per_block, rng, sampler=None):
+	chunks = data.chunks if hasattr(data, "chunks") else (64, 64, 64)
+	starts = [np.arange(0, size - s + 1, c) for size, s, c in zip(data.shape, sample_shape, chunks)]
+	weights = [np.minimum(c, size - s + 1 - start) for start, size, s, c in zip(starts, data.shape, sample_shape, chunks)]
+	weights = [w/w.sum() for w in weights]
 
 	while True:
-		batch = np.empty((batch_size, *sample_shape, 1))
+		if sampler is None:
+			block_start = [rng.choice(start, p=w) for start, w in zip(starts, weights)]
+		else:
+			block_start = [(start//c)*c for start, c in zip(sampler.sample_starts(rng, 1, sample_shape)[0], chunks)]
+		block_stop = [min(start + c + s - 1, size) for start, s, c, size in zip(block_start, sample_shape, chunks, data.shape)]
+		block = data[block_start[0]:block_stop[0], block_start[1]:block_stop[1], block_start[2]:block_stop[2]]
+
+		for _ in range(crops_per_block):
+			z, y, x = (rng.integers(0, b - s + 1) for b, s in zip(block.shape, sample_shape))
+			yield block[z:z+sample_shape[0], y:y+sample_shape[1], x:x+sample_shape[2]]
+
+
+# Uses zyx order
+## Cache region is the part of the volume ((start, stop) or None per axis) to cache and sample from, if caching
+## Crops per block > 1 draws that many samples from each chunk-aligned block read (see block_crop_generator),
+## rather than reading every sample from a uniformly random position
+def valid_data_generator_n5(container_path, dataset_path, sample_shape, batch_size, dtype=np.float32, ring_size=2,
+	cache=None, cache_dir=None, cache_region=(None, None, None), chunk_cache_bytes=0, crops_per_block=1, occupancy_threshold=None, seed=None):
+	rng = get_rng(seed)
+	data = open_dataset(container_path, dataset_path, chunk_cache_bytes)
+	data = get_cached_data(data, container_path, dataset_path, cache_region, cache, cache_dir)
+	region = cache_region if cache is not None else (None, None, None)
 
-		z_start = np.random.randint(0, data.shape[0]-sample_shape[0], batch_size)
-		y_start = np.random.randint(0, data.shape[1]-sample_shape[1], batch_size)
-		x_start = np.random.randint(0, data.shape[2]-sample_shape[2], batch_size)
+	sampler = None
+	if occupancy_threshold is not None:
+		sampler = get_occupancy_sampler(container_path, dataset_path, data, occupancy_threshold, region)
+
+	if crops_per_block > 1:
+		crops = block_crop_generator(data, sample_shape, crops_per_block, rng, sampler)
+		for batch in get_batch_ring(batch_size, sample_shape, dtype, ring_size):
+			for k in range(batch_size):
+				batch[k, :, :, :, 0] = next(crops)
+			yield normalize_batch(batch)
+		return
+
+	for batch in get_batch_ring(batch_size, sample_shape, dtype, ring_size):
+		if sampler is None:
+			z_start = rng.integers(0, data.shape[0]-sample_shape[0], batch_size)
+			y_start = rng.integers(0, data.shape[1]-sample_shape[1], batch_size)
+			x_start = rng.integers(0, data.shape[2]-sample_shape[2], batch_size)
+		else:
+			z_start, y_start, x_start = sampler.sample_starts(rng, batch_size, sample_shape).T
 
 		for k in range(batch_size):
 			batch[k, :, :, :, 0] = data[z_start[k]:z_start[k]+sample_shape[0],
 										y_start[k]:y_start[k]+sample_shape[1],
 										x_start[k]:x_start[k]+sample_shape[2]]
 
-		yield batch/255.
+		yield normalize_batch(batch)
+
+
+## Returns a function that fills in the gap_slices z slices around each sample's gap (relative_gap, one z index per sample)
+## in a batch, interpolating linearly between the slices just below and above them. It works on the whole batch at once
+## through a flat (sample*z) view of it, with all intermediate results kept in scratch buffers allocated up front.
+def get_gap_blender(batch_shape, dtype=np.float32, gap_slices=1):
+	batch_size, depth = batch_shape[:2]
+	integer_batch = not np.issubdtype(dtype, np.floating)
+	scratch_dtype = np.float32 if integer_batch else dtype
+	below, diff, blended = (np.empty((batch_size, *batch_shape[2:]), dtype=scratch_dtype) for _ in range(3))
+	sample_rows = np.arange(batch_size)*depth
+
+	def take_rows(rows, indices, out):
+		if rows.dtype == out.dtype:
+			np.take(rows, indices, axis=0, out=out)
+		else:
+			out[...] = rows[indices]
+
+	def blend_gap(batch, relative_gap):
+		rows = batch.reshape((batch_size*depth, *batch_shape[2:]))
+		first_rows = sample_rows + relative_gap - (gap_slices-1)//2
+
+		take_rows(rows, first_rows - 1, below)
+		take_rows(rows, first_rows + gap_slices, diff)
+		np.subtract(diff, below, out=diff)
+
+		for i in range(gap_slices):
+			np.multiply(diff, (i + 1.)/(gap_slices + 1.), out=blended)
+			np.add(blended, below, out=blended)
+			if integer_batch:
+				# storing into an integer batch truncates, round first so the blend isn't biased downwards
+				np.rint(blended, out=blended)
+			rows[first_rows + i] = blended
+
+	return blend_gap
 
 
 # Uses zyx order
 ## Gap Location is the z slice in pixels where the gap is centered
 ## Gap variance is the +/- amount in z pixels when grabbing gap chunks
-## Gap blend determines whether to make the gap_location z slice an average of the layers above and below (+/- 1 z pixel)
+## Gap blend determines whether to fill in the gap slices by interpolating between the layers above and below them
 ## (this is because in one case the gap slice is zeroed out and completely black)
-def gap_data_generator_n5(container_path, dataset_path, sample_shape, batch_size, gap_location, gap_variance=1, gap_blend=True):
-	data = z5py.File(container_path, use_zarr_format=False)[dataset_path]
+## Gap slices is how many z slices, centered on gap_location, are blended over (1 is just the gap_location slice)
+## With caching, only the slab of z slices around the gap that samples can come from is cached
+## With an occupancy threshold, only the chunks in the row of chunks holding the gap decide where crops can be taken in y and x
+def gap_data_generator_n5(container_path, dataset_path, sample_shape, batch_size, gap_location, gap_variance=1, gap_blend=True,
+	dtype=np.float32, ring_size=2, cache=None, cache_dir=None, chunk_cache_bytes=0, gap_slices=1, occupancy_threshold=None, seed=None):
+	rng = get_rng(seed)
+	data = open_dataset(container_path, dataset_path, chunk_cache_bytes)
 
-	while True:
-		batch = np.empty((batch_size, *sample_shape, 1))
+	sampler = None
+	if occupancy_threshold is not None:
+		gap_row = gap_location//data.chunks[0]
+		mask = np.zeros(get_occupancy_index(container_path, dataset_path).shape[1:], dtype=bool)
+		mask[gap_row] = True
+		sampler = get_occupancy_sampler(container_path, dataset_path, data, occupancy_threshold, (None, None, None), mask)
+
+	if cache is not None:
+		z_first = gap_location - sample_shape[0]//2 - gap_variance
+		data = get_cached_data(data, container_path, dataset_path, [(z_first, z_first + sample_shape[0] + 2*gap_variance), None, None], cache, cache_dir)
+		gap_location -= z_first
 
+	blend_gap = get_gap_blender((batch_size, *sample_shape, 1), dtype, gap_slices)
+
+	for batch in get_batch_ring(batch_size, sample_shape, dtype, ring_size):
 		z_start = np.full((batch_size,), gap_location - sample_shape[0]//2)
-		z_start += np.random.randint(-gap_variance, gap_variance+1, batch_size)
-		y_start = np.random.randint(0, data.shape[1]-sample_shape[1], batch_size)
-		x_start = np.random.randint(0, data.shape[2]-sample_shape[2], batch_size)
+		z_start += rng.integers(-gap_variance, gap_variance+1, batch_size)
+		if sampler is None:
+			y_start = rng.integers(0, data.shape[1]-sample_shape[1], batch_size)
+			x_start = rng.integers(0, data.shape[2]-sample_shape[2], batch_size)
+		else:
+			_, y_start, x_start = sampler.sample_starts(rng, batch_size, sample_shape).T
 
 		for k in range(batch_size):
 			batch[k, :, :, :, 0] = data[z_start[k]:z_start[k]+sample_shape[0],
 										y_start[k]:y_start[k]+sample_shape[1],
 										x_start[k]:x_start[k]+sample_shape[2]]
-			if gap_blend:
-				relative_gap = gap_location - z_start[k]
-				batch[k, relative_gap, :, :, 0] = np.mean(
-					np.concatenate((batch[k, relative_gap-1:relative_gap, :, :, 0], batch[k, relative_gap+1:relative_gap+2, :, :, 0],),
-					 axis=0),
-					 axis=0)
-
-		yield batch/255.
\ No newline at end of file
+
+		if gap_blend:
+			blend_gap(batch, gap_location - z_start)
+
+		yield normalize_batch(batch)
+
+
+## Reads a manifest of gap datasets, a csv file with a header and the columns container, dataset, gap_location
+## and optionally weight (relative sampling weight, 1 if left out), into a list of (container, dataset, gap_location, weight)
+def read_gap_manifest(manifest_path):
+	with open(manifest_path, newline="") as f:
+		return [(row["container"], row["dataset"], int(row["gap_location"]), float(row["weight"]) if row.get("weight") else 1.)
+				for row in csv.DictReader(f)]
+
+
+class DatasetHandles(object):
+	""" Keeps up to max_open z5py datasets open, closing (dropping) the least recently used one past that.
+	chunk_cache_bytes, if nonzero, gives every open dataset its own chunk cache of that size, which is dropped
+	along with it (so unlike open_dataset's caches, they are not shared, and don't show up in chunk_cache_stats).
+	"""
+	def __init__(self, max_open, chunk_cache_bytes=0):
+		self.max_open = max_open
+		self.chunk_cache_bytes = chunk_cache_bytes
+		self.handles = OrderedDict()
+
+	def get(self, container_path, dataset_path):
+		key = (container_path, dataset_path)
+		if key in self.handles:
+			self.handles.move_to_end(key)
+		else:
+			data = open_dataset(container_path, dataset_path)
+			self.handles[key] = ChunkCache(data, self.chunk_cache_bytes) if self.chunk_cache_bytes > 0 else data
+			while len(self.handles) > self.max_open:
+				self.handles.popitem(last=False)
+		return self.handles[key]
+
+
+# Uses zyx order
+## Like gap_data_generator_n5, but draws every sample from one of several gap datasets, given as a manifest
+## (list of (container, dataset, gap_location, weight), see read_gap_manifest) and picked with probability
+## proportional to its weight. Up to max_open_datasets datasets are kept open between batches, each with a
+## chunk cache of chunk_cache_bytes if that is nonzero.
+def multi_gap_data_generator_n5(manifest, sample_shape, batch_size, gap_variance=1, gap_blend=True, dtype=np.float32, ring_size=2,
+	gap_slices=1, max_open_datasets=16, chunk_cache_bytes=0, seed=None):
+	rng = get_rng(seed)
+	handles = DatasetHandles(max_open_datasets, chunk_cache_bytes)
+	weights = np.array([entry[3] for entry in manifest], dtype=np.float64)
+	weights /= weights.sum()
+	gap_locations = np.array([entry[2] for entry in manifest])
+
+	blend_gap = get_gap_blender((batch_size, *sample_shape, 1), dtype, gap_slices)
+
+	for batch in get_batch_ring(batch_size, sample_shape, dtype, ring_size):
+		entries = rng.choice(len(manifest), size=batch_size, p=weights)
+		z_start = gap_locations[entries] - sample_shape[0]//2
+		z_start += rng.integers(-gap_variance, gap_variance+1, batch_size)
+
+		# group the samples by entry, so each dataset is only looked up once per batch
+		for entry in np.unique(entries):
+			data = handles.get(*manifest[entry][:2])
+			for k in np.flatnonzero(entries == entry):
+				y_start = rng.integers(0, data.shape[1]-sample_shape[1])
+				x_start = rng.integers(0, data.shape[2]-sample_shape[2])
+				batch[k, :, :, :, 0] = data[z_start[k]:z_start[k]+sample_shape[0],
+											y_start:y_start+sample_shape[1],
+											x_start:x_start+sample_shape[2]]
+
+		if gap_blend:
+			blend_gap(batch, gap_locations[entries] - z_start)
+
+		yield normalize_batch(batch)
+
+
+## Randomly flips and rotates (by multiples of 90 degrees) every sample of a batch in the yx plane, in place.
+## Samples are grouped by transform, so a batch takes one vectorised copy per transform used (at most 8, made
+## of strided flip/transpose views) rather than one per sample. z is left alone, so gaps stay where they are.
+## Rotations by 90 degrees are only used if samples are square in yx.
+def augment_batch(batch, rng=None):
+	rng = get_rng(rng)
+	num_transforms = 8 if batch.shape[2] == batch.shape[3] else 4
+	transforms = rng.integers(0, num_transforms, len(batch))
+
+	for transform in range(1, num_transforms):
+		samples = np.flatnonzero(transforms == transform)
+		if len(samples) == 0:
+			continue
+		view = batch[samples]
+		if transform & 1:
+			view = view[:, :, ::-1]
+		if transform & 2:
+			view = view[:, :, :, ::-1]
+		if transform & 4:
+			view = view.swapaxes(2, 3)
+		batch[samples] = view
+
+	return batch
+
+def augmented_generator(generator, seed=None):
+	rng = get_rng(seed)
+	for batch in generator:
+		yield augment_batch(batch, rng)
+
+
+## Runs batch generators on background threads, keeping up to queue_size batches ready before the training loop asks for them.
+## generator_factory is called once by each of the num_workers threads with the worker's index, to make that worker's
+## own generator, since a single generator can't be advanced from several threads. Give each worker its own seed
+## (e.g. spawn_seeds(seed, num_workers)[index]): every worker's stream is then reproducible, though the order
+## batches of different workers arrive in isn't.
+## Errors raised in a worker are re-raised in the training loop.
+## Closing the returned generator (.close(), once the training loop is done with it) stops the workers and frees
+## their batches, otherwise they stay blocked on the full queue for as long as the process runs.
+## Up to queue_size+2 batches of each worker are alive at once, so its generator needs a ring_size of at least that.
+def prefetch_generator(generator_factory, queue_size=4, num_workers=1):
+	batches = queue.Queue(maxsize=queue_size)
+	stop = threading.Event()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				batches.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def worker(index):
+		try:
+			for batch in generator_factory(index):
+				if not put((batch, None)):
+					break
+		except Exception as e:
+			put((None, e))
+
+	workers = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(num_workers)]
+	for thread in workers:
+		thread.start()
+
+	try:
+		while True:
+			batch, error = batches.get()
+			if error is not None:
+				raise error
+			yield batch
+	finally:
+		stop.set()
+		for thread in workers:
+			thread.join()
+		while not batches.empty():
+			batches.get_nowait()
@@ -1,7 +1,19 @@
 from keras.models import load_model
 import z5py
 import argparse
+import bisect
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 ## Note: You have to run export CUDA_VISIBLE_DEVICES=# (replace # with GPU number) before running
 ## this script, or else it will steal all the GPUs.
@@ -12,32 +24,486 @@ def get_argparser():
 	parser.add_argument('-c', '--container', type=str, help="path to container to run on", required=True)
 	parser.add_argument('-i', '--input', type=str, help="input dataset (within container)", required=True)
 	parser.add_argument('-o', '--output', type=str, help="output dataset (within container)", required=True)
-	parser.add_argument('-z', '--zgap', type=int, help="location of the gap in pixels (z slice number)", required=True)
+	parser.add_argument('-z', '--zgap', type=int, nargs='+', help="location(s) of the gap(s) in pixels (z slice number)", required=True)
+	parser.add_argument('-b', '--batch-size', type=int, help="number of tiles to run through the generator per predict call", default=1)
+	parser.add_argument('--read-threads', type=int, help="number of threads prefetching input tiles", default=2)
+	parser.add_argument('--write-threads', type=int, help="number of threads writing finished tiles to the output dataset", default=2)
+	parser.add_argument('--prefetch', type=int, help="number of rows of tiles to read ahead of the generator", default=2)
+	parser.add_argument('--overlap', type=int, help="voxels of overlap between neighbouring output tiles, blended together to hide seams", default=0)
+	parser.add_argument('--blend-window', type=str, choices=sorted(BLEND_WINDOWS), help="weighting used to blend overlapping tiles", default="linear")
+	parser.add_argument('--shard', type=shard_spec, help="only predict shard i of N of the gap plane, given as i/N", default=(0, 1))
+	parser.add_argument('-p', '--processes', type=int, help="number of worker processes to split this run's shard between", default=1)
+	parser.add_argument('--summary', type=str, help="path to write a JSON summary of the run's throughput and timings to", default=None)
+	parser.add_argument('--no-journal', action='store_true', help="don't record finished blocks, so an interrupted run can't be resumed")
+	parser.add_argument('--restart', action='store_true', help="ignore (and delete) the journal of earlier runs on this gap and predict everything again")
 	return parser
 
-def run_prediction(generator_model, input_dataset, output_dataset, zgap):
+def shard_spec(v):
+	try:
+		index, count = (int(n) for n in v.split("/"))
+	except ValueError:
+		raise argparse.ArgumentTypeError('Shard expected in the form i/N!')
+	if not 0 <= index < count:
+		raise argparse.ArgumentTypeError('Shard index must be in [0, N)!')
+	return (index, count)
+
+## Neighbouring tiles overlap by input_size-output_size voxels, so rather than reading every tile on its own,
+## a whole row of tiles is read as one strip and the tiles are sliced out of it as views.
+def read_strip(input_dataset, planner, y, xs):
+	z_target, input_size = planner.z_target, planner.input_size
+	return input_dataset[z_target:z_target+input_size, y:y+input_size, xs[0]:xs[-1]+input_size]
+
+
+class TilePlanner(object):
+	""" Lays out the prediction tiles for one gap plane and groups their outputs by the chunk grid of the
+	output dataset. The region covered by the tiles is split along the chunk boundaries in y and x into
+	write blocks, so every N5 chunk is written exactly once, by exactly one block.
+
+	overlap -> number of voxels neighbouring output tiles overlap by (tiles step by output_size-overlap).
+
+	shard -> (i, N) restricts the plan to the i-th of N contiguous bands of block rows. Shards own disjoint
+	sets of chunks, so they can run concurrently on the same output dataset. Tiles straddling two bands
+	are predicted by both shards, but each one only writes the part inside its own band.
+	"""
+	def __init__(self, input_shape, chunks, input_size, output_size, zgap, shard=(0, 1), overlap=0):
+		if not 0 <= overlap < output_size:
+			raise ValueError("Overlap has to be in [0, %d)!" % output_size)
+		self.input_size = input_size
+		self.output_size = output_size
+		self.overlap = overlap
+		self.offset = (input_size-output_size)//2
+		self.z_target = zgap - (input_size//2)
+		self.z_range = (zgap - (output_size//2), zgap - (output_size//2) + output_size)
+
+		ys = self.get_starts(input_shape[1])
+		xs = self.get_starts(input_shape[2])
+
+		self.edges = [self.get_edges(starts, chunk) for starts, chunk in ((ys, chunks[1]), (xs, chunks[2]))]
+
+		num_rows = max(len(self.edges[0]) - 1, 0)
+		first_row, last_row = (num_rows*shard[0])//shard[1], (num_rows*(shard[0]+1))//shard[1]
+
+		self.tiles = []
+		self.blocks = {}
+		self.tile_blocks = {}
+		for tile in ((y, x) for y in ys for x in xs):
+			rows, cols = (self.get_overlap(edges, start+self.offset) for edges, start in zip(self.edges, tile))
+			blocks = [(row, col) for row in rows if first_row <= row < last_row for col in cols]
+			if blocks:
+				self.tiles.append(tile)
+				self.tile_blocks[tile] = blocks
+				for block in blocks:
+					self.blocks[block] = self.blocks.get(block, 0) + 1
+
+	def get_starts(self, length):
+		""" Tiles step by output_size-overlap, with a last tile flush against the far edge of the plane
+		(overlapping the one before it) so nothing is left unpredicted there.
+		"""
+		if length < self.input_size:
+			return []
+		starts = list(range(0, length - self.input_size + 1, self.output_size - self.overlap))
+		if starts[-1] != length - self.input_size:
+			starts.append(length - self.input_size)
+		return starts
+
+	def get_edges(self, starts, chunk):
+		if not starts:
+			return []
+		lower, upper = starts[0] + self.offset, starts[-1] + self.offset + self.output_size
+		return [lower] + list(range((lower//chunk + 1)*chunk, upper, chunk)) + [upper]
+
+	def get_overlap(self, edges, start):
+		first = bisect.bisect_right(edges, start) - 1
+		last = bisect.bisect_left(edges, start + self.output_size) - 1
+		return range(first, last + 1)
+
+	def get_block_bounds(self, block):
+		return tuple((edges[i], edges[i+1]) for edges, i in zip(self.edges, block))
+
+	def get_rows(self):
+		""" Returns the planned tiles as a list of rows, (y, [x, ...]), in order. """
+		return [(y, [x for _, x in row]) for y, row in itertools.groupby(self.tiles, key=lambda tile: tile[0])]
+
+	def exclude(self, blocks):
+		""" Drops the given blocks from the plan, along with any tiles that no longer feed a remaining block. """
+		for block in blocks:
+			self.blocks.pop(block, None)
+		for tile in self.tiles:
+			self.tile_blocks[tile] = [block for block in self.tile_blocks[tile] if block in self.blocks]
+		self.tiles = [tile for tile in self.tiles if self.tile_blocks[tile]]
+		self.blocks = {block: 0 for block in self.blocks}
+		for tile in self.tiles:
+			for block in self.tile_blocks[tile]:
+				self.blocks[block] += 1
+
+
+class CompletionJournal(object):
+	""" Records which write blocks of a gap plane have been written, so a restarted run can skip them.
+
+	Each shard keeps its own bitmap over the block grid in a .npz file inside journal_dir, next to the
+	output dataset. On startup the bitmaps of all earlier runs on the same gap are merged, as long as they
+	were made with the same block grid (i.e. the same generator and output chunking), whatever the sharding.
+	Saves are atomic and happen at most every save_interval seconds, plus once when the run finishes.
+	"""
+	def __init__(self, journal_dir, planner, zgap, shard=(0, 1), save_interval=30.):
+		self.edges = [np.array(edges) for edges in planner.edges]
+		self.done = np.zeros([max(len(edges) - 1, 0) for edges in self.edges], dtype=bool)
+		self.pattern = os.path.join(journal_dir, "z%d-*.npz" % zgap)
+		self.path = os.path.join(journal_dir, "z%d-shard%d-of-%d.npz" % (zgap, shard[0], shard[1]))
+		self.save_interval = save_interval
+		self.last_save = time.time()
+		self.lock = threading.RLock()
+
+		if not os.path.exists(journal_dir):
+			os.makedirs(journal_dir, exist_ok=True)
+
+		for path in glob.glob(self.pattern):
+			with np.load(path) as journal:
+				if all(np.array_equal(journal[name], edges) for name, edges in zip(("y_edges", "x_edges"), self.edges)):
+					self.done |= journal["done"]
+
+	def finished_blocks(self):
+		return [tuple(block) for block in np.argwhere(self.done)]
+
+	def mark(self, block):
+		with self.lock:
+			self.done[block] = True
+			if time.time() - self.last_save > self.save_interval:
+				self.save()
+
+	def save(self):
+		with self.lock:
+			with open(self.path + ".tmp", "wb") as f:
+				np.savez(f, y_edges=self.edges[0], x_edges=self.edges[1], done=self.done)
+			os.replace(self.path + ".tmp", self.path)
+			self.last_save = time.time()
+
+	@staticmethod
+	def clear(journal_dir, zgap):
+		for path in glob.glob(os.path.join(journal_dir, "z%d-*.npz" % zgap)):
+			os.remove(path)
+
+
+def get_linear_window(size, overlap):
+	ramp = np.minimum(np.arange(1, size+1), np.arange(size, 0, -1))/(overlap + 1.)
+	return np.minimum(ramp, 1.)
+
+def get_cosine_window(size, overlap):
+	return 0.5 - 0.5*np.cos(np.pi*get_linear_window(size, overlap))
+
+def get_flat_window(size, overlap):
+	return np.ones(size)
+
+## Weight profiles along y and x used for blending overlapping tiles. Weights never reach zero,
+## so a voxel covered by a single tile (e.g. at the edge of the plane) just keeps that tile's value.
+BLEND_WINDOWS = {
+	"linear": get_linear_window,
+	"cosine": get_cosine_window,
+	"flat": get_flat_window
+}
+
+
+class OutputBuffer(object):
+	""" Holds the predicted tiles in memory until every tile overlapping a write block has been added,
+	at which point the complete block is handed back for writing.
+
+	Block buffers have the output dataset's dtype and are recycled once written (see release),
+	so after the first couple of rows no new buffers get allocated.
+
+	window -> if given, the (output_size, output_size) yx weights tiles are blended with. Each block then
+	gets a float32 accumulator of weighted outputs plus one of weights, which are only divided out and
+	converted to the output dtype once the block is complete. Otherwise later tiles simply overwrite
+	earlier ones where they overlap. Blended tiles are expected unrounded (see to_output_range).
+	"""
+	def __init__(self, planner, dtype, window=None):
+		self.planner = planner
+		self.dtype = dtype
+		self.window = window
+		self.remaining = dict(planner.blocks)
+		self.buffers = {}
+		self.free = {}
+		self.lock = threading.Lock()
+
+	def get_buffer(self, shape, dtype=None):
+		dtype = np.dtype(self.dtype if dtype is None else dtype)
+		with self.lock:
+			if self.free.get((shape, dtype)):
+				return self.free[(shape, dtype)].pop()
+		return np.empty(shape, dtype=dtype)
+
+	def release(self, buffer):
+		with self.lock:
+			self.free.setdefault((buffer.shape, buffer.dtype), []).append(buffer)
+
+	def add(self, tile, out_block):
+		finished = []
+		depth = self.planner.z_range[1] - self.planner.z_range[0]
+		for block in self.planner.tile_blocks[tile]:
+			(y0, y1), (x0, x1) = self.planner.get_block_bounds(block)
+			if block not in self.buffers:
+				if self.window is None:
+					self.buffers[block] = self.get_buffer((depth, y1-y0, x1-x0))
+				else:
+					self.buffers[block] = (self.get_buffer((depth, y1-y0, x1-x0), np.float32), self.get_buffer((y1-y0, x1-x0), np.float32))
+					self.buffers[block][0].fill(0)
+					self.buffers[block][1].fill(0)
+
+			ty, tx = (start + self.planner.offset for start in tile)
+			ys, ye = max(y0, ty), min(y1, ty+self.planner.output_size)
+			xs, xe = max(x0, tx), min(x1, tx+self.planner.output_size)
+			if self.window is None:
+				self.buffers[block][:, ys-y0:ye-y0, xs-x0:xe-x0] = out_block[:, ys-ty:ye-ty, xs-tx:xe-tx]
+			else:
+				weights = self.window[ys-ty:ye-ty, xs-tx:xe-tx]
+				self.buffers[block][0][:, ys-y0:ye-y0, xs-x0:xe-x0] += out_block[:, ys-ty:ye-ty, xs-tx:xe-tx]*weights
+				self.buffers[block][1][ys-y0:ye-y0, xs-x0:xe-x0] += weights
+
+			self.remaining[block] -= 1
+			if self.remaining[block] == 0:
+				finished.append((block, self.finish(self.buffers.pop(block))))
+		return finished
+
+	def finish(self, buffer):
+		if self.window is None:
+			return buffer
+		values, weights = buffer
+		np.divide(values, weights, out=values)
+		data = self.get_buffer(values.shape)
+		data[...] = to_output_range(values, self.dtype, scale=False)
+		self.release(values)
+		self.release(weights)
+		return data
+
+
+def write_block(output_dataset, output_buffer, block, data, journal=None):
+	z_range = output_buffer.planner.z_range
+	(y0, y1), (x0, x1) = output_buffer.planner.get_block_bounds(block)
+	output_dataset[z_range[0]:z_range[1], y0:y1, x0:x1] = data
+	output_buffer.release(data)
+	if journal is not None:
+		journal.mark(block)
+
+
+class PredictionStats(object):
+	""" Keeps track of how far along a prediction run is and where its time goes. Stage timings are summed
+	over all the threads running them, so read and write can add up to more than the wall time. The
+	"wait_read" and "wait_write" stages are the time the generator sat idle waiting on I/O, which is what
+	tells an I/O-bound run apart from a compute-bound one.
+	"""
+	STAGES = ("read", "predict", "write", "wait_read", "wait_write")
+
+	def __init__(self, total_tiles, tile_voxels, report_interval=30.):
+		self.total_tiles = total_tiles
+		self.tile_voxels = tile_voxels
+		self.report_interval = report_interval
+		self.tiles = 0
+		self.times = {stage: 0. for stage in self.STAGES}
+		self.start = self.last_report = time.time()
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def timer(self, stage):
+		start = time.time()
+		try:
+			yield
+		finally:
+			with self.lock:
+				self.times[stage] += time.time() - start
+
+	def timed(self, stage, func, *args):
+		with self.timer(stage):
+			return func(*args)
+
+	def add_tiles(self, count):
+		self.tiles += count
+		now = time.time()
+		if now - self.last_report > self.report_interval or self.tiles == self.total_tiles:
+			self.last_report = now
+			tiles_per_sec = self.tiles/max(now - self.start, 1e-9)
+			eta = (self.total_tiles - self.tiles)/max(tiles_per_sec, 1e-9)
+			print("%d/%d tiles, %.2f tiles/s, %.3g voxels/s, ETA %.0fs" % (self.tiles, self.total_tiles,
+				tiles_per_sec, tiles_per_sec*self.tile_voxels, eta))
+
+	def summary(self, **info):
+		elapsed = time.time() - self.start
+		with self.lock:
+			times = dict(self.times)
+		return dict(info, tiles=self.tiles, voxels=self.tiles*self.tile_voxels, elapsed=elapsed,
+			tiles_per_sec=self.tiles/max(elapsed, 1e-9), voxels_per_sec=self.tiles*self.tile_voxels/max(elapsed, 1e-9), times=times)
+
+
+def merge_summaries(summaries, elapsed):
+	""" Totals up the summaries of several runs (gaps or shards) that took elapsed seconds of wall time. """
+	tiles = sum(summary["tiles"] for summary in summaries)
+	voxels = sum(summary["voxels"] for summary in summaries)
+	times = {stage: sum(summary["times"][stage] for summary in summaries) for stage in PredictionStats.STAGES}
+	return {"runs": summaries, "tiles": tiles, "voxels": voxels, "elapsed": elapsed, "tiles_per_sec": tiles/max(elapsed, 1e-9),
+		"voxels_per_sec": voxels/max(elapsed, 1e-9), "times": times}
+
+
+def to_output_range(out_blocks, dtype, scale=True):
+	""" Scales the generator output back to [0, 255] in place, rounding and clipping it first
+	if it's going to be stored as integers (pass float32 as dtype to leave it unrounded).
+	"""
+	if scale:
+		np.multiply(out_blocks, 255, out=out_blocks)
+	if np.issubdtype(dtype, np.integer):
+		np.rint(out_blocks, out=out_blocks)
+		np.clip(out_blocks, 0, 255, out=out_blocks)
+	return out_blocks
+
+
+## Tiles are collected into batches of batch_size blocks so the generator is only called once per batch,
+## which matters a lot on CPU where the per-call overhead of predict dominates for single blocks.
+## Reading and writing run in their own thread pools (read_threads / write_threads), so that the z5py I/O
+## is hidden behind the forward passes, with up to prefetch rows of tiles read ahead of the generator (see read_strip).
+## Outputs are buffered and written in blocks aligned to the output dataset's chunks (see TilePlanner).
+## If journal_dir is given, written blocks are recorded there and skipped when the run is restarted.
+## The input batch is a single float32 buffer reused for every batch, normalised straight from the strips.
+## With overlap > 0, neighbouring tiles overlap by that many voxels and are blended with the given window
+## (one of BLEND_WINDOWS), trading extra forward passes for less visible seams.
+## Progress is printed as it goes, and a summary of the run (see PredictionStats) is returned.
+def run_prediction(generator_model, input_dataset, output_dataset, zgap, batch_size=1, read_threads=2, write_threads=2, prefetch=2, shard=(0, 1),
+	journal_dir=None, overlap=0, blend_window="linear"):
 	input_size = generator_model.input.shape[1].value
 	output_size = generator_model.output.shape[1].value
-	z_target = zgap - (input_size//2)
-	for y in range(0, input_dataset.shape[1] - input_size, output_size):
-		for x in range(0, input_dataset.shape[2] - input_size, output_size):
-			big_block = input_dataset[z_target:z_target+input_size, y:y+input_size, x:x+input_size]/255.
-			big_block = np.expand_dims(np.expand_dims(big_block, 3), 0)
-			out_block = generator_model.predict(big_block)
-			output_dataset[zgap-(output_size//2):zgap+(output_size//2),
-					y+((input_size-output_size)//2):y+((input_size-output_size)//2)+output_size,
-					x+((input_size-output_size)//2):x+((input_size-output_size)//2)+output_size] = 255*out_block[0, :, :, :, 0]
-			print(x,y)
 
-def main():
-	args = get_argparser().parse_args()
+	planner = TilePlanner(input_dataset.shape, output_dataset.chunks, input_size, output_size, zgap, shard=shard, overlap=overlap)
+
+	journal = None
+	if journal_dir is not None:
+		journal = CompletionJournal(journal_dir, planner, zgap, shard=shard)
+		planner.exclude(journal.finished_blocks())
+
+	window = None
+	if overlap > 0:
+		profile = BLEND_WINDOWS[blend_window](output_size, overlap).astype(np.float32)
+		window = np.outer(profile, profile)
+
+	output_buffer = OutputBuffer(planner, output_dataset.dtype, window=window)
+	tile_dtype = output_buffer.dtype if window is None else np.float32
+	rows = iter(planner.get_rows())
+	big_blocks = np.empty((batch_size, input_size, input_size, input_size, 1), dtype=np.float32)
+	stats = PredictionStats(len(planner.tiles), output_size**3)
+
+	try:
+		with ThreadPoolExecutor(read_threads) as reader, ThreadPoolExecutor(write_threads) as writer:
+			def submit_read():
+				row = next(rows, None)
+				if row is not None:
+					reads.append((row, reader.submit(stats.timed, "read", read_strip, input_dataset, planner, *row)))
+
+			def predict_batch(batch_tiles, big_blocks):
+				with stats.timer("predict"):
+					out_blocks = to_output_range(generator_model.predict(big_blocks, batch_size=len(batch_tiles)), tile_dtype)
+
+					for k, tile in enumerate(batch_tiles):
+						for block, data in output_buffer.add(tile, out_blocks[k, :, :, :, 0]):
+							writes.append(writer.submit(stats.timed, "write", write_block, output_dataset, output_buffer, block, data, journal))
+				stats.add_tiles(len(batch_tiles))
 
+				# don't let finished blocks pile up in memory if writing can't keep up
+				with stats.timer("wait_write"):
+					while len(writes) > 2*write_threads:
+						writes.popleft().result()
+
+			reads, writes = deque(), deque()
+			for _ in range(max(prefetch, 1)):
+				submit_read()
+
+			batch_tiles = []
+			while reads:
+				(y, xs), strip = reads.popleft()
+				submit_read()
+				with stats.timer("wait_read"):
+					strip = strip.result()
+
+				for x in xs:
+					np.multiply(strip[:, :, x-xs[0]:x-xs[0]+input_size], np.float32(1/255.), out=big_blocks[len(batch_tiles), :, :, :, 0], casting="unsafe")
+					batch_tiles.append((y, x))
+
+					if len(batch_tiles) == batch_size:
+						predict_batch(batch_tiles, big_blocks)
+						batch_tiles = []
+
+			if batch_tiles:
+				predict_batch(batch_tiles, big_blocks[:len(batch_tiles)])
+
+			with stats.timer("wait_write"):
+				while writes:
+					writes.popleft().result()
+	finally:
+		# whatever made it to disk is recorded, even if the run died
+		if journal is not None:
+			journal.save()
+
+	return stats.summary(zgap=zgap, shard=list(shard))
+
+def get_journal_dir(args):
+	return None if args.no_journal else os.path.join(args.container, args.output.strip("/") + ".journal")
+
+def predict_shard(args, shard, results=None):
 	generator = load_model(args.generator)
 	container = z5py.File(args.container)
 	input_ds = container[args.input]
 	output_ds = container[args.output]
 
-	run_prediction(generator, input_ds, output_ds, args.zgap)
+	summaries = []
+	for zgap in args.zgap:
+		summaries.append(run_prediction(generator, input_ds, output_ds, zgap, batch_size=args.batch_size,
+			read_threads=args.read_threads, write_threads=args.write_threads, prefetch=args.prefetch, shard=shard,
+			journal_dir=get_journal_dir(args), overlap=args.overlap, blend_window=args.blend_window))
+
+	if results is not None:
+		results.put(summaries)
+	return summaries
+
+def write_summary(args, summaries, start):
+	summary = merge_summaries(summaries, time.time() - start)
+	print(json.dumps(summary))
+	if args.summary is not None:
+		with open(args.summary, "w") as f:
+			json.dump(summary, f, indent=2)
+
+def main():
+	args = get_argparser().parse_args()
+	shard_index, num_shards = args.shard
+	start = time.time()
+
+	if args.restart and get_journal_dir(args) is not None:
+		for zgap in args.zgap:
+			CompletionJournal.clear(get_journal_dir(args), zgap)
+
+	if args.processes <= 1:
+		write_summary(args, predict_shard(args, args.shard), start)
+		return
+
+	# every worker loads its own copy of the model, "spawn" keeps them from inheriting any TF state
+	context = multiprocessing.get_context("spawn")
+	results = context.Queue()
+	workers = [context.Process(target=predict_shard, args=(args, (shard_index*args.processes + i, num_shards*args.processes), results))
+				for i in range(args.processes)]
+	for worker in workers:
+		worker.start()
+
+	# collect the results before joining, a worker can't exit until its result has been read off the queue
+	worker_summaries = []
+	while len(worker_summaries) < len(workers):
+		try:
+			worker_summaries.append(results.get(timeout=10))
+		except queue.Empty:
+			if not any(worker.is_alive() for worker in workers):
+				break # a worker died without putting its result
+	for worker in workers:
+		worker.join()
+
+	failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+	if failed:
+		raise Exception("Prediction failed in worker(s) %s" % failed)
+	if len(worker_summaries) < len(workers):
+		raise Exception("Only %d of %d prediction workers returned a summary" % (len(worker_summaries), len(workers)))
+
+	write_summary(args, [summary for summaries in worker_summaries for summary in summaries], start)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,5 @@
 from keras.layers import Input
 from keras.losses import mean_squared_error
-from PIL import Image
 
 import numpy as np
 import tensorflow as tf
@@ -10,6 +9,8 @@ import os
 import pandas
 import argparse
 
+from train import BackgroundWriter, write_montage
+
 
 def get_center_of_block(block, target_shape):
 	start_pos = [(a-b)//2 for a, b in zip(block.shape[1:-1], target_shape)]
@@ -21,10 +22,11 @@ def get_center_of_block(block, target_shape):
 ## on the GPU when trying to allocate. For the largest model (a), this has to be 1.
 
 def pretrain(generator, generator_optimizer, epochs, minibatch_size, num_minibatch, input_shape, output_shape,
-	valid_generator, base_save_dir):
+	valid_generator, base_save_dir, background_samples=True):
 	""" Pre-trains the given generator using the given parameters and valid data generator.
 
 	valid_generator -> should be a generator that returns entirely valid data of size (minibatch_size, *output_shape, 1)
+	background_samples -> write each epoch's sample montage on a background thread
 
 	"""
 
@@ -48,18 +50,12 @@ def pretrain(generator, generator_optimizer, epochs, minibatch_size, num_minibat
 		persistent_sample[i*minibatch_size:min(i*minibatch_size+minibatch_size,18)] = samp[:min(minibatch_size,18-i*minibatch_size)]
 	persistent_sample_center = get_center_of_block(persistent_sample, output_shape)
 
+	sample_writer = BackgroundWriter(background_samples)
+
 	def sample_and_write_output(output_directory, epoch, width=32):
-		block_height = output_shape[1]
-		block_length = output_shape[2]
-		slices = [slice(None)]*3
-		im = np.zeros((18*2*block_height, width*block_length))
-		for i in range(18): ## TODO: do this in minibatches
-			sample_prediction = generator.predict(persistent_sample[i:i+1])[0]
-			for j in range(width):
-				slices[0] = slice(round(j*output_shape[0]/width),round(j*output_shape[0]/width)+1)
-				im[i*2*block_height:(i*2+1)*block_height,block_length*j:block_length*(j+1)] = persistent_sample_center[i, slices[0], slices[1], slices[2], 0]
-				im[(i*2+1)*block_height:(i*2+2)*block_height,block_length*j:block_length*(j+1)] = sample_prediction[slices[0], slices[1], slices[2], 0]
-		Image.fromarray(np.clip((255*im).round(),0,255).astype(np.uint8)).save(os.path.join(output_directory, "sample_epoch_%03d.png" % epoch))
+		sample_prediction = generator.predict(persistent_sample, batch_size=minibatch_size)
+		sample_writer.submit(write_montage, os.path.join(output_directory, "sample_epoch_%03d.png" % epoch), persistent_sample_center,
+			sample_prediction, slice_index=0, width=width)
 
 
 	for epoch in range(1,epochs+1):
@@ -82,6 +78,8 @@ def pretrain(generator, generator_optimizer, epochs, minibatch_size, num_minibat
 		sample_and_write_output(output_directory=os.path.join(base_save_dir, "samples"), epoch=epoch)
 
 
+	sample_writer.close()
+
 	with open(os.path.join(base_save_dir,"history.csv"),"w") as f:
 		pandas.DataFrame(history).reindex(columns=history_cols).to_csv(f, index=False)
 
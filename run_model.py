@@ -36,6 +36,67 @@ def str2bool(v, var=None):
 	else:
 		raise argparse.ArgumentTypeError('Boolean value expected%s!' % ('for variable %s' % var if var else ''))
 
+def parse_region(v):
+	""" Parses a region like "0:500,:,1000:3000" into a (start, stop) pair per axis, None for a whole axis. """
+	return tuple(None if bounds.strip() == ":" else tuple(int(b) for b in bounds.split(":")) for bounds in v.split(","))
+
+def get_cache_args(global_args, valid=False):
+	cache_args = {}
+	if "chunk_cache_mb" in global_args:
+		cache_args["chunk_cache_bytes"] = int(float(global_args["chunk_cache_mb"])*2**20)
+
+	cache = global_args["data_cache"] if "data_cache" in global_args else "none"
+	if cache == "none":
+		return cache_args
+
+	cache_args.update(cache=cache, cache_dir=global_args["data_cache_dir"] if "data_cache_dir" in global_args else None)
+	if valid and "valid_cache_region" in global_args:
+		cache_args["cache_region"] = parse_region(global_args["valid_cache_region"])
+	return cache_args
+
+def get_sampling_args(global_args, valid=False):
+	sampling_args = {}
+	if valid and "valid_crops_per_block" in global_args:
+		sampling_args["crops_per_block"] = int(global_args["valid_crops_per_block"])
+	if "occupancy_min_mean" in global_args or "occupancy_min_std" in global_args:
+		sampling_args["occupancy_threshold"] = (float(global_args["occupancy_min_mean"]) if "occupancy_min_mean" in global_args else 0.,
+												float(global_args["occupancy_min_std"]) if "occupancy_min_std" in global_args else 0.)
+	return sampling_args
+
+def print_chunk_cache_stats():
+	for dataset, stats in data_utils.chunk_cache_stats().items():
+		print(f"Chunk cache {dataset}: {stats['hits']} hits, {stats['misses']} misses ({100*stats['hit_rate']:.1f}% hit rate), {stats['nbytes']/2**20:.0f} MB cached")
+
+## Every generator of a run gets its own stream of random numbers, derived from global.seed (if given)
+DATA_STREAMS = {"pretrain_valid": 0, "train_valid": 1, "train_gap": 2}
+
+def get_data_seed(global_args, stream):
+	seed = int(global_args["seed"]) if "seed" in global_args else None
+	return data_utils.SeedSequence(seed, spawn_key=(DATA_STREAMS[stream],))
+
+def get_data_generator(global_args, seed, generator_fn, *args, **kwargs):
+	""" Makes one of the data_utils generators, augmenting its batches if global.augment is set, and running it
+	in the background if global.prefetch_batches > 0. Each prefetch worker gets its own part of seed.
+	"""
+	prefetch_batches = int(global_args["prefetch_batches"]) if "prefetch_batches" in global_args else 4
+	prefetch_workers = int(global_args["prefetch_workers"]) if "prefetch_workers" in global_args else 1
+	augment = str2bool(global_args["augment"], "global.augment") if "augment" in global_args else False
+
+	if prefetch_batches > 0:
+		# the batch buffers must outlive the queue (see prefetch_generator)
+		kwargs.setdefault("ring_size", prefetch_batches + 3)
+
+	worker_seeds = data_utils.spawn_seeds(seed, max(prefetch_workers, 1))
+
+	def generator_factory(index):
+		sampling_seed, augment_seed = data_utils.spawn_seeds(worker_seeds[index], 2)
+		generator = generator_fn(*args, seed=sampling_seed, **kwargs)
+		return data_utils.augmented_generator(generator, augment_seed) if augment else generator
+
+	if prefetch_batches <= 0:
+		return generator_factory(0)
+	return data_utils.prefetch_generator(generator_factory, queue_size=prefetch_batches, num_workers=prefetch_workers)
+
 def handle_pretrain(global_args, pretrain_args):
 	architecture_specs = models.ARCHITECTURES["generator"][pretrain_args["generator_architecture"]]
 
@@ -53,11 +114,17 @@ def handle_pretrain(global_args, pretrain_args):
 	base_save_dir = os.path.join(global_args["run_output"],"pretrain")
 	os.makedirs(base_save_dir)
 
-	valid_data_generator = data_utils.valid_data_generator_n5(global_args["valid_container"], global_args["valid_dataset"], input_shape, minibatch_size)
+	valid_data_generator = get_data_generator(global_args, get_data_seed(global_args, "pretrain_valid"), data_utils.valid_data_generator_n5, global_args["valid_container"], global_args["valid_dataset"], input_shape, minibatch_size,
+		**get_cache_args(global_args, valid=True), **get_sampling_args(global_args, valid=True))
 
-	pretrain.pretrain(generator=generator, generator_optimizer=generator_optimizer, epochs=num_epochs,
-		minibatch_size=minibatch_size, num_minibatch=num_minibatch, input_shape=input_shape, output_shape=output_shape,
-		valid_generator=valid_data_generator, base_save_dir=base_save_dir)
+	try:
+		pretrain.pretrain(generator=generator, generator_optimizer=generator_optimizer, epochs=num_epochs,
+			minibatch_size=minibatch_size, num_minibatch=num_minibatch, input_shape=input_shape, output_shape=output_shape,
+			valid_generator=valid_data_generator, base_save_dir=base_save_dir,
+			background_samples=str2bool(global_args["background_samples"], "global.background_samples") if "background_samples" in global_args else True)
+	finally:
+		# stops the background readers, if prefetching
+		valid_data_generator.close()
 
 	if models.autodetect_skipconn(generator):
 		# if it has skip connections
@@ -106,20 +173,48 @@ def handle_train(generator, global_args, train_args):
 	generator_mask_size = int(train_args["generator_mask_size"])
 	feather_size = int(train_args["feather_mask_size"]) if "feather_mask_size" in train_args else 0
 
-	gap_index = int(global_args["gap_location"])
-
-	valid_generator = data_utils.valid_data_generator_n5(global_args["valid_container"], global_args["valid_dataset"], output_shape, minibatch_size)
-	gap_generator = data_utils.gap_data_generator_n5(global_args["gap_container"], global_args["gap_dataset"], input_shape, minibatch_size, gap_index)
+	fused_generator_update = str2bool(train_args["fused_generator_update"], "train.fused_generator_update") if "fused_generator_update" in train_args else False
+	penalty_weight = float(train_args["penalty_weight"]) if "penalty_weight" in train_args else 1.0
+	reuse_gap_batch = str2bool(train_args["reuse_gap_batch"], "train.reuse_gap_batch") if "reuse_gap_batch" in train_args else False
+	graph_train_step = str2bool(train_args["graph_train_step"], "train.graph_train_step") if "graph_train_step" in train_args else False
+
+	checkpoint_interval = int(train_args["checkpoint_interval"]) if "checkpoint_interval" in train_args else 15
+	checkpoint_keep = int(train_args["checkpoint_keep"]) if "checkpoint_keep" in train_args else 0
+
+	valid_generator = get_data_generator(global_args, get_data_seed(global_args, "train_valid"), data_utils.valid_data_generator_n5, global_args["valid_container"], global_args["valid_dataset"], output_shape, minibatch_size,
+		**get_cache_args(global_args, valid=True), **get_sampling_args(global_args, valid=True))
+	gap_slices = int(global_args["gap_slices"]) if "gap_slices" in global_args else 1
+
+	if "gap_manifest" in global_args:
+		cache_args = get_cache_args(global_args)
+		if "cache" in cache_args or get_sampling_args(global_args):
+			raise Exception("global.data_cache and global.occupancy_min_mean/std can't be used together with global.gap_manifest")
+		gap_generator = get_data_generator(global_args, get_data_seed(global_args, "train_gap"), data_utils.multi_gap_data_generator_n5,
+			data_utils.read_gap_manifest(global_args["gap_manifest"]), input_shape, minibatch_size, gap_slices=gap_slices,
+			max_open_datasets=int(global_args["max_open_datasets"]) if "max_open_datasets" in global_args else 16, **cache_args)
+	else:
+		gap_index = int(global_args["gap_location"])
+		gap_generator = get_data_generator(global_args, get_data_seed(global_args, "train_gap"), data_utils.gap_data_generator_n5, global_args["gap_container"], global_args["gap_dataset"], input_shape, minibatch_size, gap_index,
+			gap_slices=gap_slices, **get_cache_args(global_args), **get_sampling_args(global_args))
 
 	base_save_dir = os.path.join(global_args["run_output"], "train")
 	os.makedirs(base_save_dir)
 
-	train.train(generator=generator, discriminator=discriminator, generator_optimizer=generator_optimizer,
-		discriminator_optimizer=discriminator_optimizer, penalty_optimizer=penalty_optimizer, epochs=num_epochs,
-		minibatch_size=minibatch_size, num_minibatch=num_minibatch, instance_noise=instance_noise,
-		instance_noise_profile=instance_noise_profile, input_shape=input_shape, output_shape=output_shape,
-		generator_mask_size=generator_mask_size, feather_size=feather_size, valid_generator=valid_generator,
-		gap_generator=gap_generator, gap_index=0, base_save_dir=base_save_dir)
+	try:
+		train.train(generator=generator, discriminator=discriminator, generator_optimizer=generator_optimizer,
+			discriminator_optimizer=discriminator_optimizer, penalty_optimizer=penalty_optimizer, epochs=num_epochs,
+			minibatch_size=minibatch_size, num_minibatch=num_minibatch, instance_noise=instance_noise,
+			instance_noise_profile=instance_noise_profile, input_shape=input_shape, output_shape=output_shape,
+			generator_mask_size=generator_mask_size, feather_size=feather_size, valid_generator=valid_generator,
+			gap_generator=gap_generator, gap_index=0, base_save_dir=base_save_dir,
+			fused_generator_update=fused_generator_update, penalty_weight=penalty_weight, reuse_gap_batch=reuse_gap_batch,
+			graph_train_step=graph_train_step,
+			background_samples=str2bool(global_args["background_samples"], "global.background_samples") if "background_samples" in global_args else True,
+			checkpoint_interval=checkpoint_interval, checkpoint_keep=checkpoint_keep)
+	finally:
+		# stops the background readers, if prefetching
+		valid_generator.close()
+		gap_generator.close()
 
 	generator.save(os.path.join(base_save_dir, "generator-final.h5"))
 	discriminator.save(os.path.join(base_save_dir, "discriminator-final.h5"))
@@ -157,6 +252,8 @@ def main():
 		# handle train here
 		handle_train(generator, config["global"], config["train"])
 
+	print_chunk_cache_stats()
+
 
 if __name__=="__main__":
 	main()
\ No newline at end of file
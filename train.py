@@ -1,6 +1,8 @@
 from keras.layers import Input
-from keras.losses import mean_squared_error, mean_absolute_error
+from keras.losses import mean_squared_error, mean_absolute_error, binary_crossentropy
+from keras.metrics import binary_accuracy
 from keras.models import Model
+from keras import backend as K
 from PIL import Image
 
 import numpy as np
@@ -8,38 +10,46 @@ import tensorflow as tf
 import math
 
 import os
+import h5py
+import keras
 import pandas
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
-def get_masked_loss(batch_size, output_shape, mask_size, slice_index, feather_size=0, base_loss=mean_absolute_error):
+def get_masked_loss(output_shape, mask_size, slice_index, feather_size=0, base_loss=mean_absolute_error):
+	""" Loss that ignores the middle mask_size slices of the block along slice_index (feathered over feather_size
+	slices on each side). The mask only varies along slice_index, so it is kept as a 1-D profile that broadcasts
+	over any batch size, normalised to a mean of 1 over the block.
+	"""
 
-	mask = np.zeros((batch_size,) + output_shape + (1,), dtype=np.float32)
-	slices = [slice(None)]*3
+	profile = np.zeros(output_shape[slice_index], dtype=np.float32)
 
 	lower_bound = (output_shape[slice_index] - mask_size)//2
 	upper_bound = (output_shape[slice_index] + mask_size)//2
 
-	# set lower to 1
-	slices[slice_index] = slice(None,lower_bound)
-	mask[:, slices[0], slices[1], slices[2], :] = 1.0
-
-	# set upper to 1
-	slices[slice_index] = slice(upper_bound,None)
-	mask[:, slices[0], slices[1], slices[2], :] = 1.0
+	# set lower and upper to 1
+	profile[:lower_bound] = 1.0
+	profile[upper_bound:] = 1.0
 
 	for i in range(feather_size):
-		slices[slice_index] = lower_bound - i - 1
-		mask[:, slices[0], slices[1], slices[2], :] = (i + 1.0) / (feather_size + 1.0)
-		slices[slice_index] = upper_bound + i
-		mask[:, slices[0], slices[1], slices[2], :] = (i + 1.0) / (feather_size + 1.0)
+		profile[lower_bound - i - 1] = (i + 1.0) / (feather_size + 1.0)
+		profile[upper_bound + i] = (i + 1.0) / (feather_size + 1.0)
+
+	profile *= profile.size / profile.sum()
 
-	mask *= mask.size / mask.sum()
+	mask_shape = [1]*5
+	mask_shape[slice_index+1] = profile.size
+	mask = K.constant(profile.reshape(mask_shape))
 
-	def masked_loss(y_true, y_pred):
-		y_true_masked = tf.multiply(y_true, mask)
-		y_pred_masked = tf.multiply(y_pred, mask)
-		return base_loss(y_true_masked, y_pred_masked)
+	if base_loss is mean_absolute_error:
+		# the mask is non-negative, so |mask*y_true - mask*y_pred| == mask*|y_true - y_pred|
+		def masked_loss(y_true, y_pred):
+			return K.mean(mask * K.abs(y_pred - y_true), axis=-1)
+	else:
+		def masked_loss(y_true, y_pred):
+			return base_loss(y_true * mask, y_pred * mask)
 
 	return masked_loss
 
@@ -56,14 +66,190 @@ def get_center_of_block(block, target_shape):
 	return block[:,slices[0],slices[1],slices[2]]
 
 
+def get_sample_montage(centers, predictions, slice_index=0, width=32, extra_views=False):
+	""" Lays out width evenly spaced slices (along slice_index) of each sample, with the true center of the block on
+	one row and the prediction on the row below. extra_views adds a slice through the middle of the other two axes
+	(hard coded for blocks with equal sides for now).
+	"""
+	rows = np.stack([centers[..., 0], predictions[..., 0]], axis=1) # (samples, 2, *output_shape)
+	axes = (slice_index, (slice_index+1)%3, (slice_index+2)%3)
+	rows_by_slice = rows.transpose(0, 1, *(a+2 for a in axes))
+	positions = np.minimum(np.round(np.arange(width)*rows_by_slice.shape[2]/width).astype(int), rows_by_slice.shape[2]-1)
+	tiles = rows_by_slice[:, :, positions] # (samples, 2, width, block_height, block_length)
+
+	if extra_views:
+		tiles = np.concatenate([tiles, rows[:, :, None, :, rows.shape[3]//2, :], rows[:, :, None, :, :, rows.shape[4]//2]], axis=2)
+
+	samples, _, columns, block_height, block_length = tiles.shape
+	return tiles.transpose(0, 1, 3, 2, 4).reshape(samples*2*block_height, columns*block_length)
+
+
+def write_montage(path, *args, **kwargs):
+	im = get_sample_montage(*args, **kwargs)
+	Image.fromarray(np.clip((255*im).round(),0,255).astype(np.uint8)).save(path)
+
+
+class BackgroundWriter(object):
+	""" Runs write jobs one at a time, on a background thread if background is set. Only the writing is moved off
+	the calling thread, anything that touches the graph (predictions, reading weights) should happen before submit.
+	"""
+	def __init__(self, background=True):
+		self.executor = ThreadPoolExecutor(1) if background else None
+		self.pending = None
+
+	def submit(self, fn, *args, **kwargs):
+		self.wait()
+		if self.executor is None:
+			fn(*args, **kwargs)
+		else:
+			self.pending = self.executor.submit(fn, *args, **kwargs)
+
+	def wait(self):
+		if self.pending is not None:
+			self.pending.result()
+			self.pending = None
+
+	def close(self):
+		self.wait()
+		if self.executor is not None:
+			self.executor.shutdown()
+
+
+def get_model_snapshot(model):
+	""" Copies everything needed to write model as a Keras HDF5 file (architecture and weights) into memory. """
+	weight_names = [(layer.name, [w.name for w in layer.weights]) for layer in model.layers]
+	weight_values = K.batch_get_value([w for layer in model.layers for w in layer.weights])
+	return model.to_json(), weight_names, weight_values
+
+
+def write_model_snapshot(path, snapshot):
+	""" Writes a snapshot from get_model_snapshot in the layout of keras' model.save (without the optimizer state),
+	so it can be read back with load_model. The file only appears at path once it is complete.
+	"""
+	model_config, weight_names, weight_values = snapshot
+	weight_values = iter(weight_values)
+
+	tmp_path = path + ".tmp"
+	with h5py.File(tmp_path, "w") as f:
+		f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+		f.attrs["backend"] = K.backend().encode("utf8")
+		f.attrs["model_config"] = model_config.encode("utf8")
+
+		model_weights = f.create_group("model_weights")
+		model_weights.attrs["layer_names"] = [layer_name.encode("utf8") for layer_name, _ in weight_names]
+		model_weights.attrs["backend"] = K.backend().encode("utf8")
+		model_weights.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+		for layer_name, names in weight_names:
+			g = model_weights.create_group(layer_name)
+			g.attrs["weight_names"] = [name.encode("utf8") for name in names]
+			for name in names:
+				g.create_dataset(name, data=next(weight_values))
+	os.replace(tmp_path, path)
+
+
+class CheckpointWriter(object):
+	""" Saves models on a background thread, keeping only the last keep checkpoints of each model (all if 0).
+
+	save() only snapshots the weights and queues the write, it waits only when max_pending snapshots are already
+	queued or being written (so at most that many copies of the weights are held in memory). Write errors are
+	raised from a later save() or from close().
+	"""
+	def __init__(self, keep=0, max_pending=2):
+		self.executor = ThreadPoolExecutor(1)
+		self.pending = deque()
+		self.keep = keep
+		self.max_pending = max_pending
+		self.written = {}
+
+	def save(self, model, path):
+		while self.pending and (self.pending[0].done() or len(self.pending) >= self.max_pending):
+			self.pending.popleft().result()
+		self.pending.append(self.executor.submit(self.write, model.name, path, get_model_snapshot(model)))
+
+	def write(self, name, path, snapshot):
+		write_model_snapshot(path, snapshot)
+		written = self.written.setdefault(name, [])
+		written.append(path)
+		while self.keep > 0 and len(written) > self.keep:
+			os.remove(written.pop(0))
+
+	def close(self):
+		try:
+			while self.pending:
+				self.pending.popleft().result()
+		finally:
+			self.executor.shutdown()
+
+
+def get_train_step(generator, discriminator, generator_optimizer, discriminator_optimizer, masked_loss, penalty_weight,
+	input_shape, output_shape):
+	""" Builds the graph functions for a discriminator update and a generator update (adversarial and masked
+	penalty losses together), so a minibatch takes a single call instead of one per compiled model. The two
+	updates run as two chained graph calls, so the generator update always sees the updated discriminator.
+
+	Returns train_step(valid_data, d_gap_data, g_gap_data, noise_std_dev) -> (d_loss, d_acc, g_loss, g_penalty)
+
+	Must be called while the discriminator is still trainable, so its weights can be collected.
+	"""
+	valid_in = Input(shape=output_shape+(1,))
+	d_gap_in = Input(shape=input_shape+(1,))
+	g_gap_in = Input(shape=input_shape+(1,))
+	noise_std_dev = K.placeholder(shape=())
+
+	## Discriminator update, on real blocks and (noisy) generated blocks
+	fake_block = K.stop_gradient(generator(d_gap_in))
+	fake_block = K.clip(fake_block + noise_std_dev*K.random_normal(K.shape(fake_block)), 0.0, 1.0)
+	d_real = discriminator(valid_in)
+	d_fake = discriminator(fake_block)
+	d_loss = 0.5*(K.mean(binary_crossentropy(K.ones_like(d_real), d_real)) + K.mean(binary_crossentropy(K.zeros_like(d_fake), d_fake)))
+	d_acc = 0.5*(K.mean(binary_accuracy(K.ones_like(d_real), d_real)) + K.mean(binary_accuracy(K.zeros_like(d_fake), d_fake)))
+
+	d_updates = discriminator_optimizer.get_updates(loss=d_loss, params=discriminator.trainable_weights)
+	d_updates += discriminator.get_updates_for(valid_in) + discriminator.get_updates_for(fake_block)
+
+	d_step = K.function([valid_in, d_gap_in, noise_std_dev, K.learning_phase()], [d_loss, d_acc], updates=d_updates)
+
+	## Generator update, run after d_step so it is against the updated discriminator
+	## (within one graph call the discriminator's weight reads aren't ordered after its updates)
+	g_block = generator(g_gap_in)
+	g_pred = discriminator(g_block)
+	start = [(a-b)//2 for a, b in zip(input_shape, output_shape)]
+	g_center = g_gap_in[:, start[0]:start[0]+output_shape[0], start[1]:start[1]+output_shape[1], start[2]:start[2]+output_shape[2]]
+	g_loss = K.mean(binary_crossentropy(K.ones_like(g_pred), g_pred))
+	g_penalty = K.mean(masked_loss(g_center, g_block))
+
+	g_updates = generator_optimizer.get_updates(loss=g_loss + penalty_weight*g_penalty, params=generator.trainable_weights)
+	g_updates += generator.get_updates_for(g_gap_in)
+
+	g_step = K.function([g_gap_in, K.learning_phase()], [g_loss, g_penalty], updates=g_updates)
+
+	def train_step(valid_data, d_gap_data, g_gap_data, noise_std_dev=0.0):
+		return d_step([valid_data, d_gap_data, noise_std_dev, 1]) + g_step([g_gap_data, 1])
+
+	return train_step
+
+
 def train(generator, discriminator, generator_optimizer, discriminator_optimizer, penalty_optimizer,
 	epochs, minibatch_size, num_minibatch, instance_noise, instance_noise_profile, input_shape, output_shape,
-	generator_mask_size, feather_size, valid_generator, gap_generator, gap_index, base_save_dir):
+	generator_mask_size, feather_size, valid_generator, gap_generator, gap_index, base_save_dir,
+	fused_generator_update=False, penalty_weight=1.0, reuse_gap_batch=False, graph_train_step=False,
+	background_samples=True, checkpoint_interval=15, checkpoint_keep=0):
 	""" Trains the given generator using all the given parameters and generators.
 
 	valid_generator -> should be a generator that returns entirely valid data of size (minibatch_size, *output_shape, 1)
 	gap_generator   -> should be a generator that returns data with a gap in the middle of size (minibatch_size, *input_shape, 1)
 
+	fused_generator_update -> update the generator with the adversarial and masked penalty losses together, in one
+	                          forward/backward pass, using generator_optimizer (penalty_optimizer is then unused)
+	penalty_weight         -> weight of the penalty loss relative to the adversarial loss, if fused_generator_update
+	reuse_gap_batch        -> train the generator on the gap batch from the discriminator step, instead of drawing a new one
+	graph_train_step       -> do each minibatch's discriminator and (fused) generator updates with one call to two chained
+	                          graph functions (see get_train_step), instead of through the compiled models
+	background_samples     -> write each epoch's sample montage on a background thread
+	checkpoint_interval    -> save the generator and discriminator every checkpoint_interval epochs (0 to never),
+	                          on a background thread
+	checkpoint_keep        -> number of most recent checkpoints of each model to keep (0 to keep all)
+
 	"""
 
 	discriminator.compile(loss='binary_crossentropy', optimizer=discriminator_optimizer, metrics=['accuracy'])
@@ -71,16 +257,28 @@ def train(generator, discriminator, generator_optimizer, discriminator_optimizer
 	generator.name = "pretrained_generator"
 	generator.compile(loss='binary_crossentropy', optimizer=generator_optimizer)
 
-	penalty_z = Input(shape=input_shape+(1,))
-	penalty = Model(penalty_z, generator(penalty_z))
-	penalty.compile(loss=get_masked_loss(minibatch_size, output_shape, generator_mask_size, gap_index, feather_size=feather_size), optimizer=penalty_optimizer)
-
-	z = Input(shape=input_shape+(1,))
-	fake_block = generator(z)
-	discriminator.trainable = False
-	disc_pred = discriminator(fake_block)
-	combined = Model(z, disc_pred)
-	combined.compile(loss='binary_crossentropy', optimizer=generator_optimizer)
+	masked_loss = get_masked_loss(output_shape, generator_mask_size, gap_index, feather_size=feather_size)
+
+	if graph_train_step:
+		train_step = get_train_step(generator, discriminator, generator_optimizer, discriminator_optimizer, masked_loss,
+			penalty_weight, input_shape, output_shape)
+	else:
+		z = Input(shape=input_shape+(1,))
+		fake_block = generator(z)
+		discriminator.trainable = False
+		disc_pred = discriminator(fake_block)
+
+		if fused_generator_update:
+			# one model with both losses on its two outputs, so the generator only runs once per update
+			fused = Model(z, [disc_pred, fake_block])
+			fused.compile(loss=['binary_crossentropy', masked_loss], loss_weights=[1.0, penalty_weight], optimizer=generator_optimizer)
+		else:
+			penalty_z = Input(shape=input_shape+(1,))
+			penalty = Model(penalty_z, generator(penalty_z))
+			penalty.compile(loss=masked_loss, optimizer=penalty_optimizer)
+
+			combined = Model(z, disc_pred)
+			combined.compile(loss='binary_crossentropy', optimizer=generator_optimizer)
 
 	test_sample = gap_generator.__next__()
 
@@ -93,6 +291,8 @@ def train(generator, discriminator, generator_optimizer, discriminator_optimizer
 	if not os.path.exists(os.path.join(base_save_dir, "samples")):
 		os.makedirs(os.path.join(base_save_dir, "samples"))
 
+	checkpoint_writer = CheckpointWriter(checkpoint_keep)
+
 
 	def update_and_print_history(epoch, d_loss, d_acc, g_loss, g_penalty):
 		history["epoch"].append(epoch)
@@ -109,27 +309,12 @@ def train(generator, discriminator, generator_optimizer, discriminator_optimizer
 		persistent_sample[i*minibatch_size:min(i*minibatch_size+minibatch_size,18)] = samp[:min(minibatch_size,18-i*minibatch_size)]
 	persistent_sample_center = get_center_of_block(persistent_sample, output_shape)
 
-	def sample_and_write_output(output_directory, epoch, width=32):
-		block_height = output_shape[(gap_index+1)%3]
-		block_length = output_shape[(gap_index+2)%3]
-		slices = [slice(None)]*3
-		im = np.zeros((18*2*block_height, (width+2)*block_length))
-		#sample_prediction = np.zeros((18, *output_shape, 1))
-		for i in range(18): ## TODO: do this in minibatches
-			sample_prediction = generator.predict(persistent_sample[i:i+1])[0]
-			for j in range(width):
-				slices[gap_index] = slice(round(j*output_shape[gap_index]/width),round(j*output_shape[gap_index]/width)+1)
-				im[i*2*block_height:(i*2+1)*block_height,block_length*j:block_length*(j+1)] = persistent_sample_center[i, slices[0], slices[1], slices[2], 0]
-				im[(i*2+1)*block_height:(i*2+2)*block_height,block_length*j:block_length*(j+1)] = sample_prediction[slices[0], slices[1], slices[2], 0]
-
-			im[i*2*block_height:(i*2+1)*block_height,block_length*width:block_length*(width+1)] = persistent_sample_center[i, :, output_shape[1]//2, :, 0]
-			im[(i*2+1)*block_height:(i*2+2)*block_height,block_length*width:block_length*(width+1)] = sample_prediction[:, output_shape[1]//2, :, 0]
-
-			im[i*2*block_height:(i*2+1)*block_height,block_length*(width+1):block_length*(width+2)] = persistent_sample_center[i, :, :, output_shape[2]//2, 0]
-			im[(i*2+1)*block_height:(i*2+2)*block_height,block_length*(width+1):block_length*(width+2)] = sample_prediction[:, :, output_shape[2]//2, 0]
-			# hard coded for now
+	sample_writer = BackgroundWriter(background_samples)
 
-		Image.fromarray(np.clip((255*im).round(),0,255).astype(np.uint8)).save(os.path.join(output_directory, "sample_epoch_%03d.png" % epoch))
+	def sample_and_write_output(output_directory, epoch, width=32):
+		sample_prediction = generator.predict(persistent_sample, batch_size=minibatch_size)
+		sample_writer.submit(write_montage, os.path.join(output_directory, "sample_epoch_%03d.png" % epoch), persistent_sample_center,
+			sample_prediction, slice_index=gap_index, width=width, extra_views=True)
 
 
 	for epoch in range(1,epochs+1):
@@ -137,29 +322,49 @@ def train(generator, discriminator, generator_optimizer, discriminator_optimizer
 		d_loss, g_loss, g_loss_penalty = None, None, None
 
 		for _ in range(num_minibatch):
-			
-			## Train the Discriminator
-			gap_data = gap_generator.__next__()
-			gen_output = generator.predict(gap_data)
 
-			if instance_noise:
-				gen_output = apply_noise(gen_output, instance_noise_profile[epoch])
+			if graph_train_step:
+				## Train the Discriminator and the Generator in one call
+				gap_data = gap_generator.__next__()
+				valid_data = valid_generator.__next__()
+				g_gap_data = gap_data if reuse_gap_batch else gap_generator.__next__()
+
+				d_loss_step, d_acc_step, g_loss_step, g_loss_penalty_step = train_step(valid_data, gap_data, g_gap_data,
+					instance_noise_profile[epoch] if instance_noise else 0.0)
 
-			valid_data = valid_generator.__next__()
+				d_loss_new = (1./num_minibatch) * np.array([d_loss_step, d_acc_step])
+				g_loss_new = (1./num_minibatch) * g_loss_step
+				g_loss_penalty_new = (1./num_minibatch) * g_loss_penalty_step
 
-			d_loss_real = discriminator.train_on_batch(valid_data, np.ones((minibatch_size, 1)))
-			d_loss_fake = discriminator.train_on_batch(gen_output, np.zeros((minibatch_size, 1)))
-			d_loss_new = (1./num_minibatch) * 0.5 * np.add(d_loss_real, d_loss_fake)
+			else:
+				## Train the Discriminator
+				gap_data = gap_generator.__next__()
+				gen_output = generator.predict(gap_data)
 
+				if instance_noise:
+					gen_output = apply_noise(gen_output, instance_noise_profile[epoch])
 
-			## Train the Generator
-			gap_data = gap_generator.__next__()
+				valid_data = valid_generator.__next__()
 
-			## Through the Discriminator
-			g_loss_new = (1./num_minibatch) * combined.train_on_batch(gap_data, np.ones((minibatch_size)))
+				d_loss_real = discriminator.train_on_batch(valid_data, np.ones((minibatch_size, 1)))
+				d_loss_fake = discriminator.train_on_batch(gen_output, np.zeros((minibatch_size, 1)))
+				d_loss_new = (1./num_minibatch) * 0.5 * np.add(d_loss_real, d_loss_fake)
 
-			## Penalty Training
-			g_loss_penalty_new = (1./num_minibatch) * penalty.train_on_batch(gap_data, get_center_of_block(gap_data, output_shape))
+
+				## Train the Generator
+				if not reuse_gap_batch:
+					gap_data = gap_generator.__next__()
+
+				if fused_generator_update:
+					## Through the Discriminator and Penalty Training at once
+					_, g_loss_new, g_loss_penalty_new = (1./num_minibatch) * np.array(fused.train_on_batch(gap_data,
+						[np.ones((minibatch_size, 1)), get_center_of_block(gap_data, output_shape)]))
+				else:
+					## Through the Discriminator
+					g_loss_new = (1./num_minibatch) * combined.train_on_batch(gap_data, np.ones((minibatch_size)))
+
+					## Penalty Training
+					g_loss_penalty_new = (1./num_minibatch) * penalty.train_on_batch(gap_data, get_center_of_block(gap_data, output_shape))
 
 
 			## Record Losses
@@ -171,9 +376,12 @@ def train(generator, discriminator, generator_optimizer, discriminator_optimizer
 
 		sample_and_write_output(output_directory=os.path.join(base_save_dir, "samples"), epoch=epoch)
 
-		if (epoch)%15 == 0:
-			generator.save(os.path.join(base_save_dir, "model-saves", "generator_train_epoch_%03d.h5"%(epoch+1)))
-			discriminator.save(os.path.join(base_save_dir, "model-saves", "discriminator_train_epoch_%03d.h5"%(epoch+1)))
+		if checkpoint_interval > 0 and (epoch)%checkpoint_interval == 0:
+			checkpoint_writer.save(generator, os.path.join(base_save_dir, "model-saves", "generator_train_epoch_%03d.h5"%(epoch+1)))
+			checkpoint_writer.save(discriminator, os.path.join(base_save_dir, "model-saves", "discriminator_train_epoch_%03d.h5"%(epoch+1)))
+
+	sample_writer.close()
+	checkpoint_writer.close()
 
 	with open(os.path.join(base_save_dir, "history.csv"),"w") as f:
 		pandas.DataFrame(history).reindex(columns=history_cols).to_csv(f, index=False)